@@ -31,7 +31,27 @@ For more information, see the file README.comfychair.
 To run a test suite based on ComfyChair, just run it as a program.
 """
 
-import sys, os, re, shutil
+import sys, os, re, select, struct, time
+import collections, errno, functools, glob, itertools
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(pattern):
+    """Compile and cache a regular expression used by the assertions."""
+    return re.compile(pattern)
+
+
+# Properties of the process and system that cannot change while the
+# tests run, looked up once.
+_CAPS = {
+    'uid': os.getuid(),
+    'gid': os.getgid(),
+    'pidfd': hasattr(os, 'pidfd_open'),
+    'posix_spawn': hasattr(os, 'posix_spawnp'),
+    # None until _uring_lib() has looked for the liburing bindings.
+    'io_uring_waitid': None,
+    'ncpu': os.cpu_count(),
+}
 
 
 class TestCase:
@@ -40,11 +60,13 @@ class TestCase:
     utility functions for"""
 
     def __init__(self):
-        self.test_log = ""
+        # Records of what the test did, formatted only if the log is shown.
+        self._test_log = []
         self.background_pids = []
         self._cleanups = []
         self._enter_rundir()
         self._save_environment()
+        self.add_cleanup(self._close_background_fds)
         self.add_cleanup(self.teardown)
         # Prevent localizations interfering with attempts to parse
         # program output and error messages.  LC_ALL has higher
@@ -57,26 +79,106 @@ class TestCase:
     def _enter_rundir(self):
         self.basedir = os.getcwd()
         self.add_cleanup(self._restore_directory)
-        self.rundir = os.path.join(self.basedir,
-                                   '_testtmp', 
-                                   self.__class__.__name__)
-        self.tmpdir = os.path.join(self.rundir, 'tmp')
-        shutil.rmtree(self.rundir, ignore_errors=1)
-        os.makedirs(self.tmpdir)
+        if os.sep == '/':
+            # basedir is absolute, so plain formatting gives the same
+            # result as os.path.join.
+            self.rundir = '%s/_testtmp/%s' % (self.basedir,
+                                              self.__class__.__name__)
+            self.tmpdir = self.rundir + '/tmp'
+        else:
+            self.rundir = os.path.join(self.basedir,
+                                       '_testtmp',
+                                       self.__class__.__name__)
+            self.tmpdir = os.path.join(self.rundir, 'tmp')
+        # Set by runtest once the test passes.
+        self._rundir_reusable = 0
+        _fast_rmtree(self.rundir, ignore_errors=1)
+        if not self._take_pooled_rundir():
+            # Parts of a previous run's rundir may have survived.
+            os.makedirs(self.tmpdir, exist_ok=True)
         os.chdir(self.rundir)
 
     def _restore_directory(self):
         os.chdir(self.basedir)
+        if self._rundir_reusable and self._rundir_poolable():
+            self._recycle_rundir()
+
+    def _rundir_poolable(self):
+        return os.path.dirname(self.rundir) == _rundir_pool_root
+
+    def _take_pooled_rundir(self):
+        """Move an empty directory from the pool into place as the rundir.
+
+        Returns:
+          true if the rundir was taken from the pool, false if it still
+          has to be created.
+        """
+        if not self._rundir_poolable():
+            return 0
+        while _rundir_pool:
+            pooled = _rundir_pool.popleft()
+            try:
+                os.rename(pooled, self.rundir)
+                return 1
+            except FileNotFoundError:
+                # Taken by another worker process; try the next one.
+                pass
+            except OSError:
+                # The stale rundir could not be cleared out of the way,
+                # so no pooled directory can replace it.
+                _rundir_pool.appendleft(pooled)
+                return 0
+        return 0
+
+    def _recycle_rundir(self):
+        """Empty the rundir of a passed test and return it to the pool.
+
+        Rundirs with many entries are left alone; they are removed when
+        the test is next run."""
+        try:
+            with os.scandir(self.rundir) as it:
+                entries = list(it)
+            if len(entries) > _RUNDIR_POOL_MAX_ENTRIES:
+                return
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    _fast_rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+            os.mkdir(self.tmpdir)
+            pooled = _pooled_rundir_name()
+            os.rename(self.rundir, pooled)
+        except OSError:
+            return
+        _rundir_pool.append(pooled)
 
     # --------------------------------------------------
     # Save and restore environment
     def _save_environment(self):
-        self._saved_environ = os.environ.copy()
+        if _install_environ_journal():
+            # Only remember the original values of variables the test
+            # changes, rather than copying the whole environment.
+            self._env_delta = {}
+            _environ_journals.append(self._env_delta)
+        else:
+            self._env_delta = None
+            self._saved_environ = os.environ.copy()
         self.add_cleanup(self._restore_environment)
 
     def _restore_environment(self):
-        os.environ.clear()
-        os.environ.update(self._saved_environ)
+        if self._env_delta is None:
+            os.environ.clear()
+            os.environ.update(self._saved_environ)
+            return
+        for i in range(len(_environ_journals) - 1, -1, -1):
+            if _environ_journals[i] is self._env_delta:
+                del _environ_journals[i]
+                break
+        for key, value in self._env_delta.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
 
     
     def setup(self):
@@ -103,9 +205,9 @@ class TestCase:
           0 on success; 2 if a KeyboardInterrupt occurs; 1 if any other exception
           occurs.
         """
-        while self._cleanups:
+        cleanups, self._cleanups = self._cleanups, []
+        for clean_task in reversed(cleanups):
             try:
-                clean_task = self._cleanups.pop()
                 clean_task()
             except KeyboardInterrupt:
                 print("interrupted during cleanups")
@@ -115,6 +217,11 @@ class TestCase:
                 print("error during cleanups")
                 _report_error(self, debugger)
                 return 1
+            if self._cleanups:
+                # The task queued more cleanups; they run next.
+                ret = self.apply_cleanups(debugger)
+                if ret:
+                    return ret
         return 0
 
     def fail(self, reason = ""):
@@ -135,9 +242,19 @@ why."""
 
     def require_root(self):
         """Skip this test unless run by root."""
-        self.require(os.getuid() == 0,
+        self.require(_CAPS['uid'] == 0,
                      "must be root to run this test")
 
+    def require_pidfd(self):
+        """Skip this test unless processes can be waited for with pidfds."""
+        self.require(_CAPS['pidfd'],
+                     "pidfd_open is not available")
+
+    def require_ncpu(self, n):
+        """Skip this test unless there are at least n CPUs."""
+        self.require((_CAPS['ncpu'] or 1) >= n,
+                     "needs at least %d CPUs" % n)
+
     #############################################################
     # Assertion methods
 
@@ -163,7 +280,7 @@ why."""
         Raises:
           AssertionError if not matched
           """
-        if not re.match(pattern, s):
+        if not _compile(pattern).match(s):
             raise AssertionError("string does not match regexp\n"
                                  "    string: %s\n"
                                  "    re: %s" % (repr(s), repr(pattern)))
@@ -178,7 +295,7 @@ why."""
         Raises:
           AssertionError if not matched
           """
-        if not re.search(pattern, s):
+        if not _compile(pattern).search(s):
             raise AssertionError("string does not contain regexp\n"
                                  "    string: %s\n"
                                  "    re: %s" % (repr(s), repr(pattern)))
@@ -192,18 +309,101 @@ why."""
     # Methods for running programs
 
     def runcmd_background(self, cmd):
-        self.test_log = self.test_log + "Run in background:\n" + repr(cmd) + "\n"
-        pid = os.fork()
-        if pid == 0:
-            # child
+        self._test_log.append(('background', cmd))
+        pid = _spawn(["/bin/sh", "-c", cmd])
+        self._test_log.append(('pid', pid))
+        fd = None
+        if _CAPS['pidfd']:
             try:
-                os.execvp("/bin/sh", ["/bin/sh", "-c", cmd])
-            finally:
-                os._exit(127)
-        self.test_log = self.test_log + "pid: %d\n" % pid
+                fd = os.pidfd_open(pid)
+            except OSError:
+                pass
+        self.background_pids.append((pid, fd))
         return pid
 
 
+    def wait_background(self, timeout = None):
+        """Wait for commands started by runcmd_background to exit.
+
+        Inputs:
+          timeout      seconds to wait, or None to wait for all of them
+
+        Returns:
+          list of (pid, waitstatus) for the children that were reaped.
+          Children that were already reaped elsewhere are dropped with a
+          waitstatus of None.
+
+        Where pidfds are available all the children are waited for with a
+        single poll(); otherwise each is reaped with a blocking waitpid and
+        the timeout is ignored.
+        """
+        reaped = []
+        waiting = {}
+        for pid, fd in self.background_pids:
+            if fd is None:
+                reaped.append((pid, _reap(pid, 0)))
+            else:
+                waiting[fd] = pid
+        if waiting:
+            poller = select.poll()
+            for fd in waiting:
+                poller.register(fd, select.POLLIN)
+            if timeout is not None:
+                deadline = time.monotonic() + timeout
+            while waiting:
+                if timeout is None:
+                    events = poller.poll()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    events = poller.poll(remaining * 1000)
+                for fd, _ in events:
+                    pid = waiting.pop(fd)
+                    poller.unregister(fd)
+                    os.close(fd)
+                    reaped.append((pid, _reap(pid, os.WNOHANG)))
+        self.background_pids = [(pid, fd) for fd, pid in waiting.items()]
+        return reaped
+
+
+    def reap_background(self):
+        """Wait for all commands started by runcmd_background to exit.
+
+        Returns:
+          list of (pid, waitstatus), as from wait_background.
+
+        With the liburing bindings on Linux 6.7 or later, every child is
+        reaped by one batch of IORING_OP_WAITID requests.  Without them
+        this is the same as wait_background(), which also reaps any
+        children left over if the ring fails.
+        """
+        if not self.background_pids or not _uring_lib():
+            return self.wait_background()
+        reaped = []
+        try:
+            _uring_reap([pid for pid, fd in self.background_pids], reaped)
+            failed = 0
+        except OSError:
+            failed = 1
+        done = set(pid for pid, status in reaped)
+        for pid, fd in self.background_pids:
+            if pid in done and fd is not None:
+                os.close(fd)
+        self.background_pids = [(pid, fd) for pid, fd in self.background_pids
+                                if pid not in done]
+        if failed:
+            reaped.extend(self.wait_background())
+        return reaped
+
+
+    def _close_background_fds(self):
+        for pid, fd in self.background_pids:
+            if fd is not None:
+                os.close(fd)
+        self.background_pids = []
+
+
     def runcmd(self, cmd, expectedResult = 0):
         """Run a command, fail if the command returns an unexpected exit
         code.  Return the output produced."""
@@ -218,54 +418,88 @@ stderr:
         return output, stderr
 
 
-    def run_captured(self, cmd):
-        """Run a command, capturing stdout and stderr.
-
-        Based in part on popen2.py
+    def runcmd_batch(self, cmds):
+        """Run a sequence of shell commands in a single shell.
+
+        This is cheaper than calling runcmd for each command.  The
+        commands are run in order, stopping at the first one that
+        returns a nonzero exit code, which fails the test.  Return the
+        output produced by all of them."""
+        statuses, output, stderr = self.runcmd_batch_unchecked(cmds)
+        for cmd, rc in zip(cmds, statuses):
+            if rc is None:
+                message = "command was not run"
+            elif rc:
+                message = "command returned %d; expected 0" % rc
+            else:
+                continue
+            raise AssertionError("""%s: \"%s\"
+stdout:
+%s
+stderr:
+%s""" % (message, cmd, output, stderr))
+        return output, stderr
 
-        Returns (waitstatus, stdout, stderr)."""
-        pid = os.fork()
-        if pid == 0:
-            # child
-            try:
-                pid = os.getpid()
-                openmode = os.O_WRONLY|os.O_CREAT|os.O_TRUNC
 
-                outfd = os.open('%d.out' % pid, openmode)
-                os.dup2(outfd, 1)
-                os.close(outfd)
+    def runcmd_batch_unchecked(self, cmds):
+        """Run a sequence of shell commands in a single shell, stopping
+        at the first one that fails.
+
+        Returns (statuses, stdout, stderr), where statuses has the exit
+        code of each command, or None for commands that were not run."""
+        # On exit, however it happens, the shell reports how many
+        # commands it started and its exit status.
+        lines = ["trap 'printf \"\\n%s %%d %%d\\n\" $__batch_i $?' EXIT"
+                 % _BATCH_STATUS]
+        for i, cmd in enumerate(cmds):
+            lines.append("__batch_i=%d\n{ %s\n} || exit" % (i, cmd))
+        lines.append("__batch_i=%d" % len(cmds))
+        rc, output, stderr = self.runcmd_unchecked('\n'.join(lines))
+        statuses = [None] * len(cmds)
+        m = _compile(r'\n%s (\d+) (\d+)\n\Z' % _BATCH_STATUS).search(output)
+        if m:
+            output = output[:m.start()]
+            started = int(m.group(1))
+            statuses[:started] = [0] * started
+            if started < len(cmds):
+                statuses[started] = int(m.group(2))
+        return statuses, output, stderr
 
-                errfd = os.open('%d.err' % pid, openmode)
-                os.dup2(errfd, 2)
-                os.close(errfd)
 
-                if isinstance(cmd, str):
-                    cmd = ['/bin/sh', '-c', cmd]
+    def run_captured(self, cmd):
+        """Run a command, capturing stdout and stderr.
 
-                os.execvp(cmd[0], cmd)
-            finally:
-                os._exit(127)
-        else:
-            # parent
-            exited_pid, waitstatus = os.waitpid(pid, 0)
-            stdout = open('%d.out' % pid).read()
-            stderr = open('%d.err' % pid).read()
-            return waitstatus, stdout, stderr
+        Returns (waitstatus, stdout, stderr), with the output as bytes."""
+        if isinstance(cmd, str):
+            if _needs_shell(cmd):
+                cmd = ['/bin/sh', '-c', cmd]
+            else:
+                cmd = _shell_words(cmd)
+        r_out, w_out = os.pipe()
+        r_err, w_err = os.pipe()
+        try:
+            pid = _spawn(cmd, [(w_out, 1), (w_err, 2)])
+        except:
+            os.close(r_out)
+            os.close(r_err)
+            raise
+        finally:
+            os.close(w_out)
+            os.close(w_err)
+        stdout, stderr = _drain(r_out, r_err)
+        exited_pid, waitstatus = os.waitpid(pid, 0)
+        return waitstatus, stdout, stderr
 
 
     def runcmd_unchecked(self, cmd, skip_on_noexec = 0):
         """Invoke a command; return (exitcode, stdout, stderr)"""
         waitstatus, stdout, stderr = self.run_captured(cmd)
+        stdout = stdout.decode('utf-8', 'replace')
+        stderr = stderr.decode('utf-8', 'replace')
         assert not os.WIFSIGNALED(waitstatus), \
                ("%s terminated with signal %d" % (repr(cmd), os.WTERMSIG(waitstatus)))
         rc = os.WEXITSTATUS(waitstatus)
-        self.test_log = self.test_log + ("""Run command: %s
-Wait status: %#x (exit code %d, signal %d)
-stdout:
-%s
-stderr:
-%s""" % (cmd, waitstatus, os.WEXITSTATUS(waitstatus), os.WTERMSIG(waitstatus),
-         stdout, stderr))
+        self._test_log.append(('run', cmd, waitstatus, stdout, stderr))
         if skip_on_noexec and rc == 127:
             # Either we could not execute the command or the command
             # returned exit code 127.  According to system(3) we can't
@@ -274,6 +508,12 @@ stderr:
         return rc, stdout, stderr
     
 
+    @property
+    def test_log(self):
+        """Everything logged so far, as a single string."""
+        return '\n'.join(_format_record(r) for r in self._test_log)
+
+
     def explain_failure(self, exc_info = None):
         print("test_log:")
         print(self.test_log)
@@ -283,7 +523,340 @@ stderr:
         """Log a message to the test log.  This message is displayed if
         the test fails, or when the runtests function is invoked with
         the verbose option."""
-        self.test_log = self.test_log + msg + "\n"
+        self._test_log.append(('log', msg))
+
+
+def _format_record(record):
+    """Format an entry from a test's log for display."""
+    kind = record[0]
+    if kind == 'run':
+        cmd, waitstatus, stdout, stderr = record[1:]
+        return """Run command: %s
+Wait status: %#x (exit code %d, signal %d)
+stdout:
+%s
+stderr:
+%s""" % (cmd, waitstatus, os.WEXITSTATUS(waitstatus), os.WTERMSIG(waitstatus),
+         stdout, stderr)
+    elif kind == 'background':
+        return "Run in background:\n" + repr(record[1])
+    elif kind == 'pid':
+        return "pid: %d" % record[1]
+    else:
+        return record[1]
+
+
+def _fast_rmtree(path, ignore_errors = 0):
+    """Remove a directory tree, like shutil.rmtree.
+
+    File types come from the directory entries returned by os.scandir,
+    so no extra stat is needed per file.
+
+    If ignore_errors is true, anything that cannot be removed is left
+    behind and the rest of the tree is still removed; otherwise the
+    first OSError is raised."""
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        _fast_rmtree(entry.path, ignore_errors)
+                    else:
+                        os.unlink(entry.path)
+                except OSError:
+                    if not ignore_errors:
+                        raise
+        os.rmdir(path)
+    except OSError:
+        if not ignore_errors:
+            raise
+
+
+# Empty rundirs, each with a tmp subdirectory, ready to be renamed into
+# place by the next test whose rundir is directly under
+# _rundir_pool_root.
+_rundir_pool = collections.deque()
+_rundir_pool_root = None
+_rundir_pool_serial = itertools.count()
+_RUNDIR_POOL_MAX_ENTRIES = 64
+
+
+def _pooled_rundir_name():
+    return os.path.join(_rundir_pool_root, '.pool.%d.%d'
+                        % (os.getpid(), next(_rundir_pool_serial)))
+
+
+def _prime_rundir_pool(count):
+    """Create count empty rundirs under ./_testtmp for tests to use."""
+    global _rundir_pool_root
+    _rundir_pool_root = os.path.join(os.getcwd(), '_testtmp')
+    for i in range(count - len(_rundir_pool)):
+        pooled = _pooled_rundir_name()
+        os.makedirs(os.path.join(pooled, 'tmp'))
+        _rundir_pool.append(pooled)
+
+
+def _drain_rundir_pool():
+    """Remove the unused pooled rundirs, including other processes'."""
+    _rundir_pool.clear()
+    if _rundir_pool_root:
+        for pooled in glob.glob(os.path.join(_rundir_pool_root, '.pool.*')):
+            _fast_rmtree(pooled, ignore_errors=1)
+
+
+# Journals of the original values of environment variables changed
+# while each live TestCase is running, innermost last.  None means the
+# variable was not set.
+_environ_journals = []
+
+
+def _journaled(method):
+    def wrapper(env, key, *args):
+        if env is os.environ or env is getattr(os, 'environb', None):
+            name = os.fsdecode(key)
+            for journal in _environ_journals:
+                if name not in journal:
+                    journal[name] = os.environ.get(name)
+        return method(env, key, *args)
+    return wrapper
+
+
+def _install_environ_journal():
+    """Make changes to os.environ get recorded in _environ_journals.
+
+    Returns:
+      true if the journal is in place, false if os.environ could not be
+      hooked and tests must fall back to copying the environment.
+    """
+    environ_class = type(os.environ)
+    if getattr(environ_class, '_comfychair_journaled', False):
+        return True
+    try:
+        environ_class.__setitem__ = _journaled(environ_class.__setitem__)
+        environ_class.__delitem__ = _journaled(environ_class.__delitem__)
+        environ_class._comfychair_journaled = True
+    except (AttributeError, TypeError):
+        return False
+    return True
+
+
+def _drain(*fds):
+    """Read each of fds until EOF and close it.
+
+    The fds are read concurrently, so a child that fills one pipe cannot
+    block while we are waiting on the other.
+
+    Returns a list of bytearrays, one per fd."""
+    data = dict((fd, bytearray()) for fd in fds)
+    pending = list(fds)
+    while pending:
+        ready, _, _ = select.select(pending, [], [])
+        for fd in ready:
+            chunk = os.read(fd, 65536)
+            if chunk:
+                data[fd] += chunk
+            else:
+                pending.remove(fd)
+                os.close(fd)
+    return [data[fd] for fd in fds]
+
+
+# Characters that mean a command string must be run by the shell.
+_SHELL_CHARS = frozenset(';|&$<>*?[]`(){}\\"\'~#!\n')
+
+# Commands the shell runs itself: keywords and builtins, including the
+# builtins that also exist as programs but behave differently, such as
+# dash's echo.
+_SHELL_WORDS = frozenset(['.', ':', '[', 'alias', 'bg', 'break', 'case', 'cd',
+                          'command', 'continue', 'echo', 'eval', 'exec',
+                          'exit', 'export', 'false', 'fg', 'for', 'getopts',
+                          'hash', 'if', 'jobs', 'kill', 'local', 'printf',
+                          'pwd', 'read', 'readonly', 'return', 'set',
+                          'shift', 'source', 'test', 'time', 'times', 'trap',
+                          'true', 'type', 'ulimit', 'umask', 'unalias',
+                          'unset', 'until', 'wait', 'while'])
+
+
+def _shell_words(cmd):
+    """Split cmd into words as the shell would, given that it contains
+    none of _SHELL_CHARS: on spaces and tabs only."""
+    return _compile('[^ \t]+').findall(cmd)
+
+
+def _needs_shell(cmd):
+    """Return True unless cmd is a plain command and arguments that can be
+    run without /bin/sh."""
+    if not _SHELL_CHARS.isdisjoint(cmd):
+        return True
+    words = _shell_words(cmd)
+    # An empty command, a builtin, or a variable assignment such as
+    # "DISTCC_HOSTS=localhost distcc ...".
+    return not words or words[0] in _SHELL_WORDS or '=' in words[0]
+
+
+def _spawn(argv, dup2s = ()):
+    """Start argv in a child process, searching PATH for argv[0].
+
+    Inputs:
+      argv         command and arguments
+      dup2s        (fd, target_fd) pairs to dup2 in the child
+
+    posix_spawnp is used where possible, so that the parent's address
+    space is not copied as it is by fork.  If that is unavailable or
+    fails, we fork and exec instead, and a command that cannot be
+    executed exits with status 127, as it would from the shell.
+
+    Returns the child's pid."""
+    if _CAPS['posix_spawn']:
+        try:
+            return os.posix_spawnp(argv[0], argv, os.environ,
+                                   file_actions=[(os.POSIX_SPAWN_DUP2, fd, target)
+                                                 for fd, target in dup2s])
+        except OSError:
+            pass
+    pid = os.fork()
+    if pid == 0:
+        # child
+        try:
+            for fd, target in dup2s:
+                os.dup2(fd, target)
+            os.execvp(argv[0], argv)
+        except OSError as e:
+            os.write(2, os.fsencode("%s: %s\n" % (argv[0], e.strerror)))
+        finally:
+            os._exit(127)
+    return pid
+
+
+# liburing's C library, loaded through ctypes by _uring_lib().
+_liburing = None
+
+
+def _uring_lib():
+    """Return liburing's C library, or None if it is not available.
+
+    The liburing Python bindings link liburing into their extension
+    module, so its C functions are called through ctypes: unlike the
+    bindings' own wrappers, that lets each IORING_OP_WAITID request
+    have a siginfo buffer to fill in.  The module is only loaded the
+    first time this is called, not when comfychair is imported."""
+    global _liburing
+    if _CAPS['io_uring_waitid'] is None:
+        _CAPS['io_uring_waitid'] = 0
+        try:
+            import ctypes
+            import liburing.liburing
+            lib = ctypes.CDLL(liburing.liburing.__file__)
+            lib.io_uring_prep_waitid
+        except (ImportError, OSError, AttributeError):
+            return None
+        p, c_int, c_uint, c_u64 = (ctypes.c_void_p, ctypes.c_int,
+                                   ctypes.c_uint, ctypes.c_uint64)
+        for name, restype, argtypes in (
+                ('io_uring_queue_init', c_int, [c_uint, p, c_uint]),
+                ('io_uring_queue_exit', None, [p]),
+                ('io_uring_get_sqe', p, [p]),
+                ('io_uring_prep_waitid', None, [p, c_int, c_int, p, c_int, c_uint]),
+                ('io_uring_sqe_set_data64', None, [p, c_u64]),
+                ('io_uring_submit', c_int, [p]),
+                ('io_uring_wait_cqe', c_int, [p, ctypes.POINTER(p)]),
+                ('io_uring_cqe_seen', None, [p, p])):
+            fn = getattr(lib, name)
+            fn.restype, fn.argtypes = restype, argtypes
+        _liburing = lib
+        _CAPS['io_uring_waitid'] = 1
+    return _liburing
+
+
+def _uring_reap(pids, reaped):
+    """Reap each of pids with one batch of IORING_OP_WAITID requests.
+
+    Inputs:
+      pids         children to reap
+      reaped       list to which (pid, waitstatus) is appended as each
+                   child is reaped, so that the caller still has them if
+                   an error is raised
+
+    Raises:
+      OSError if the ring cannot be set up, or if any waitid fails, for
+      instance because the kernel is older than 6.7 or a pid is not a
+      child of this process.  The error is raised once every request
+      has completed.  If the kernel accepts only some of the requests,
+      those are waited for and EAGAIN is raised, leaving the other
+      children for the caller to reap.
+    """
+    import ctypes
+    lib = _uring_lib()
+    # struct io_uring is a little over 200 bytes; leave room to grow.
+    ring = ctypes.create_string_buffer(1024)
+    rc = lib.io_uring_queue_init(len(pids), ring, 0)
+    if rc < 0:
+        raise OSError(-rc, os.strerror(-rc))
+    # The kernel writes into these after submit, so they must outlive
+    # the ring.
+    infos = [ctypes.create_string_buffer(128) for pid in pids]
+    error = 0
+    try:
+        for i in range(len(pids)):
+            sqe = lib.io_uring_get_sqe(ring)
+            lib.io_uring_prep_waitid(sqe, os.P_PID, pids[i], infos[i],
+                                     os.WEXITED, 0)
+            lib.io_uring_sqe_set_data64(sqe, i)
+        submitted = lib.io_uring_submit(ring)
+        if submitted < 0:
+            raise OSError(-submitted, os.strerror(-submitted))
+        if submitted < len(pids):
+            error = errno.EAGAIN
+        cqe = ctypes.c_void_p()
+        for unused in range(submitted):
+            rc = lib.io_uring_wait_cqe(ring, ctypes.byref(cqe))
+            while rc == -errno.EINTR:
+                rc = lib.io_uring_wait_cqe(ring, ctypes.byref(cqe))
+            if rc < 0:
+                raise OSError(-rc, os.strerror(-rc))
+            # struct io_uring_cqe starts with __u64 user_data, __s32 res
+            i, res = struct.unpack_from('Qi', ctypes.string_at(cqe.value, 12))
+            lib.io_uring_cqe_seen(ring, cqe)
+            if res < 0:
+                error = error or -res
+            else:
+                reaped.append((pids[i], _siginfo_waitstatus(infos[i])))
+    finally:
+        lib.io_uring_queue_exit(ring)
+    if error:
+        raise OSError(error, os.strerror(error))
+
+
+def _siginfo_waitstatus(info):
+    """Convert the siginfo_t filled in by waitid() to a waitpid() status."""
+    import ctypes
+    # si_signo, si_errno and si_code are followed by a union that holds
+    # pointers, so it starts at 16 on 64-bit ABIs but at 12 on 32-bit
+    # ones.  For SIGCHLD it begins si_pid, si_uid, si_status.
+    align = ctypes.alignment(ctypes.c_void_p)
+    union = (12 + align - 1) // align * align
+    code, = struct.unpack_from('i', info, 8)
+    status, = struct.unpack_from('i', info, union + 8)
+    if code == os.CLD_EXITED:
+        return status << 8
+    elif code == os.CLD_DUMPED:
+        return status | 0x80
+    else:
+        return status
+
+
+def _reap(pid, options):
+    """waitpid() for pid, returning None if it has already been reaped."""
+    try:
+        return os.waitpid(pid, options)[1]
+    except ChildProcessError:
+        return None
+
+
+# Printed when runcmd_batch's script exits, followed by the index of the
+# command that was running (or the number of commands, if all of them
+# finished) and the shell's exit status.
+_BATCH_STATUS = '__comfychair_batch_status__'
 
 
 class NotRunError(Exception):
@@ -312,7 +885,8 @@ def _report_error(case, debugger):
         debugger(tb)
 
 
-def runtest(testcase_class, ret, verbose=0, debugger=None, subtest=0):
+def runtest(testcase_class, ret, verbose=0, debugger=None, subtest=0,
+            name=None):
     """Instantiate test class, run it, and catch and report exceptions.
 
     Inputs:
@@ -321,6 +895,7 @@ def runtest(testcase_class, ret, verbose=0, debugger=None, subtest=0):
        verbose         an integer (used as boolean)
        debugger        debugger object to be applied to errors
        subtest         an integer (used as boolean)
+       name            the test's name, if already known
     Returns:
        a new return status
     Raises:
@@ -329,16 +904,20 @@ def runtest(testcase_class, ret, verbose=0, debugger=None, subtest=0):
     If subtest is true, then the ordinary information about the
     test progress is not printed.  
     """
+    if name is None:
+        name = _test_name(testcase_class)
+    write = sys.stdout.write
     if not subtest:
-        print("%-30s" % _test_name(testcase_class), end=' ')
+        write("%-30s " % name)
         def failure_print(message):
-            print(message)
+            write(message + "\n")
     else:
         def failure_print(message):
-            print('[%s %s]' % (_test_name(testcase_class), message))
-            
-    # flush now so that long running tests are easier to follow
-    sys.stdout.flush()
+            write('[%s %s]\n' % (name, message))
+
+    if verbose:
+        # flush now so that long running tests are easier to follow
+        sys.stdout.flush()
 
     obj = None
     try:
@@ -347,8 +926,9 @@ def runtest(testcase_class, ret, verbose=0, debugger=None, subtest=0):
             obj = testcase_class()
             obj.setup()
             obj.runtest()
+            obj._rundir_reusable = 1
             if not subtest:
-                print("OK")
+                write("OK\n")
         except KeyboardInterrupt:
             failure_print("INTERRUPT")
             if obj:
@@ -364,42 +944,210 @@ def runtest(testcase_class, ret, verbose=0, debugger=None, subtest=0):
     finally:
         if obj:
             ret = obj.apply_cleanups(debugger) or ret
+        sys.stdout.flush()
     # Display log file if we're verbose
     if ret == 0 and verbose:
         obj.explain_failure()
     return ret
 
 
-def runtests(test_list, verbose = 0, debugger = None):
+def _run_one(args):
+    """Run one test in a worker process.
+
+    Output is collected rather than written straight to stdout, so that
+    the parent can print each test's report in one piece.
+
+    Returns (return status, output)."""
+    testcase_class, name, verbose, number = args
+    import io
+    saved_stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    if _worker_slot is not None:
+        _worker_slots[_worker_slot + 1] = number + 1
+    try:
+        try:
+            ret = runtest(testcase_class, 0, verbose=verbose, name=name)
+        except KeyboardInterrupt:
+            ret = 2
+        return ret, sys.stdout.getvalue()
+    finally:
+        sys.stdout = saved_stdout
+        if _worker_slot is not None:
+            _worker_slots[_worker_slot + 1] = 0
+
+
+# Shared with the workers of the last executor from _make_executor: a
+# (pid, 1 + number of the test it is running, or 0) pair per worker, so
+# that if a worker dies the parent can tell which test it was running.
+_worker_slots = None
+
+# In a worker, the index of its pair in _worker_slots.
+_worker_slot = None
+
+
+def _worker_init():
+    """Set up a worker process started by _make_executor.
+
+    Workers are forked, so they inherit the parent's imports and caches;
+    each only needs its own pooled rundir, so that workers do not race
+    for the parent's.
+
+    When one worker dies the executor kills the others with SIGTERM;
+    they clear their test from _worker_slots first, so that only the
+    test that was running in the dead worker is left there."""
+    global _worker_slot
+    import signal
+    _rundir_pool.clear()
+    _prime_rundir_pool(1)
+    with _worker_slots.get_lock():
+        for i in range(0, len(_worker_slots), 2):
+            if not _worker_slots[i]:
+                _worker_slots[i] = os.getpid()
+                _worker_slot = i
+                break
+    signal.signal(signal.SIGTERM, _worker_terminated)
+
+
+def _worker_terminated(signum, frame):
+    import signal
+    if _worker_slot is not None:
+        _worker_slots[_worker_slot + 1] = 0
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def _make_executor(jobs):
+    """Return an executor that runs tests in jobs forked worker processes."""
+    global _worker_slots
+    import concurrent.futures, multiprocessing
+    context = multiprocessing.get_context('fork')
+    _worker_slots = context.Array('l', 2 * jobs)
+    return concurrent.futures.ProcessPoolExecutor(
+        jobs, mp_context=context, initializer=_worker_init)
+
+
+def runtests(test_list, verbose = 0, debugger = None, jobs = 1,
+             executor = None):
     """Run a series of tests.
 
     Inputs:
       test_list    sequence of TestCase classes
       verbose      print more information as testing proceeds
       debugger     debugger object to be applied to errors
+      jobs         number of tests to run at once; tests are run serially
+                   if this is 1 or a debugger is given
+      executor     executor from _make_executor to run the tests in; if
+                   None, one is created for this call when jobs > 1
 
     Returns:
       unix return code: 0 for success, 1 for failures, 2 for test failure
     """
     import traceback
+    if debugger:
+        jobs = 1
+        executor = None
+    names = [_test_name(t) for t in test_list]
+    if jobs > 1 or executor:
+        # Workers prime their own pools in _worker_init.
+        _prime_rundir_pool(0)
+    else:
+        _prime_rundir_pool(min(len(test_list), 1))
+    try:
+        if executor:
+            return _runtests_parallel(test_list, names, verbose, executor)
+        elif jobs > 1:
+            executor = _make_executor(jobs)
+            try:
+                return _runtests_parallel(test_list, names, verbose,
+                                          executor)
+            finally:
+                executor.shutdown(cancel_futures=True)
+        ret = 0
+        for testcase_class, name in zip(test_list, names):
+            try:
+                ret = runtest(testcase_class, ret, verbose=verbose,
+                              debugger=debugger, name=name)
+            except KeyboardInterrupt:
+                ret = 2
+                break
+        return ret
+    finally:
+        _drain_rundir_pool()
+
+
+def _runtests_parallel(test_list, names, verbose, executor):
+    import concurrent.futures, concurrent.futures.process
     ret = 0
-    for testcase_class in test_list:
-        try:
-            ret = runtest(testcase_class, ret, verbose=verbose,
-                          debugger=debugger)
-        except KeyboardInterrupt:
-            ret = 2
-            break
+    futures = [executor.submit(_run_one, (t, name, verbose, number))
+               for number, (t, name) in enumerate(zip(test_list, names))]
+    numbers = {future: number for number, future in enumerate(futures)}
+    reported = set()
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            if isinstance(future.exception(),
+                          concurrent.futures.process.BrokenProcessPool):
+                # A worker died and broke the pool.
+                ret = _report_broken_pool(futures, names, reported, executor)
+                break
+            test_ret, output = future.result()
+            reported.add(numbers[future])
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            ret = test_ret or ret
+            if test_ret == 2:
+                break
+    except KeyboardInterrupt:
+        ret = 2
+    if ret == 2:
+        for future in futures:
+            future.cancel()
     return ret
 
 
+def _report_broken_pool(futures, names, reported, executor):
+    """Report the tests left when a worker process has died.
+
+    The test that was running in the dead worker fails; every other test
+    whose result was lost is reported as not run, since the executor is
+    broken.  Tests that finished before the pool broke are reported as
+    usual.
+
+    Returns 1."""
+    # Wait for the executor to kill the remaining workers, so that the
+    # only test left in _worker_slots is the one whose worker died.
+    executor.shutdown(wait=True)
+    died = set()
+    if _worker_slots is not None:
+        died = set(_worker_slots[i + 1] - 1
+                   for i in range(0, len(_worker_slots), 2)
+                   if _worker_slots[i + 1])
+    import concurrent.futures.process
+    broken = concurrent.futures.process.BrokenProcessPool
+    lost = [number for number, future in enumerate(futures)
+            if number not in reported
+            and isinstance(future.exception(), broken)]
+    if not died & set(lost):
+        # Not one of ours, or it was killed with SIGTERM: blame the
+        # first test that was lost.
+        died = set(lost[:1])
+    for number, future in enumerate(futures):
+        if number in reported:
+            continue
+        if number not in lost:
+            output = future.result()[1]
+        elif number in died:
+            output = "%-30s FAIL, worker process died\n" % names[number]
+        else:
+            output = "%-30s NOTRUN, process pool is broken\n" % names[number]
+        sys.stdout.write(output)
+    sys.stdout.flush()
+    return 1
+
+
 def _test_name(test_class):
     """Return a human-readable name for a test class.
     """
-    try:
-        return test_class.__name__
-    except:
-        return repr(test_class)
+    return getattr(test_class, '__name__', None) or repr(test_class)
 
 
 def print_help():
@@ -415,6 +1163,7 @@ options:
     --list              list available tests
     --verbose, -v       show more information while running tests
     --post-mortem, -p   enter Python debugger on error
+    --jobs=N, -j N      run N tests at once
 """ % sys.argv[0])
 
 
@@ -446,9 +1195,11 @@ Calls sys.exit() on completion.
 
     opt_verbose = 0
     debugger = None
+    opt_jobs = 1
 
-    opts, args = getopt.getopt(sys.argv[1:], 'pv',
-                               ['help', 'list', 'verbose', 'post-mortem'])
+    opts, args = getopt.getopt(sys.argv[1:], 'pvj:',
+                               ['help', 'list', 'verbose', 'post-mortem',
+                                'jobs='])
     for opt, opt_arg in opts:
         if opt == '--help':
             print_help()
@@ -461,20 +1212,27 @@ Calls sys.exit() on completion.
         elif opt == '--post-mortem' or opt == '-p':
             import pdb
             debugger = pdb.post_mortem
+        elif opt == '--jobs' or opt == '-j':
+            opt_jobs = int(opt_arg)
 
     if args:
-        all_tests = tests + extra_tests
-        by_name = {}
-        for t in all_tests:
-            by_name[_test_name(t)] = t
-        which_tests = []
-        for name in args:
-            which_tests.append(by_name[name])
+        # Interned names compare by identity when looked up.
+        by_name = {sys.intern(_test_name(t)): t
+                   for t in tests + extra_tests}
+        which_tests = [by_name[sys.intern(name)] for name in args]
     else:
         which_tests = tests
 
-    sys.exit(runtests(which_tests, verbose=opt_verbose,
-                      debugger=debugger))
+    executor = None
+    if opt_jobs > 1 and not debugger:
+        executor = _make_executor(opt_jobs)
+    try:
+        ret = runtests(which_tests, verbose=opt_verbose,
+                       debugger=debugger, executor=executor)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    sys.exit(ret)
 
 
 if __name__ == '__main__':
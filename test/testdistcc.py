@@ -1324,10 +1324,11 @@ class Gdb_Case(CompileHello_Case):
         # generated by distcc.  This is just to double-check
         # that we didn't modify anything other than the ".debug_info"
         # section.
-        self.runcmd(self.compiler() + self.build_id + " -o obj/testtmp.o -I. -c %s" %
-            self.sourceFilename())
-        self.runcmd(self.compiler() + self.build_id + " -o link/testtmp obj/testtmp.o")
-        self.runcmd("strip link/%s && strip run/%s" % (testtmp_exe, testtmp_exe))
+        self.runcmd_batch([
+            self.compiler() + self.build_id + " -o obj/testtmp.o -I. -c %s" %
+                self.sourceFilename(),
+            self.compiler() + self.build_id + " -o link/testtmp obj/testtmp.o",
+            "strip link/%s && strip run/%s" % (testtmp_exe, testtmp_exe)])
         # On newer versions of Linux, this works only because we pass
         # --build-id=0x12345678.
         # On OS X, the strict bit-by-bit comparison will fail, because
@@ -1689,16 +1690,14 @@ class Concurrent_Case(CompileHello_Case):
     
     def runtest(self):
         # may take about a minute or so
-        pids = {}
         for unused_i in range(50):
-            kid = self.runcmd_background(self.distcc() +
-                                         _gcc + " -o testtmp.o -c testtmp.c")
-            pids[kid] = kid
-        while len(pids):
-            pid, status = os.wait()
-            if status:
-                self.fail("child %d failed with status %#x" % (pid, status))
-            del pids[pid]
+            self.runcmd_background(self.distcc() +
+                                   _gcc + " -o testtmp.o -c testtmp.c")
+        reaped = self.reap_background()
+        self.assert_equal(len(reaped), 50)
+        for pid, status in reaped:
+            if status != 0:
+                self.fail("child %d failed with status %r" % (pid, status))
 
 
 class BigAssFile_Case(Compilation_Case):